@@ -12,69 +12,246 @@ import os
 import time
 import datetime
 import json
-import subprocess
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError: # fall back to stdlib json
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 os.environ['LANG'] = 'en_US.UTF-8'
 
+# Pooled HTTP session (keep-alive) shared by all download threads
+# Cached on disk by requests_cache (if installed); revalidated with
+# ETag/Last-Modified after 1 day
+try:
+    import requests_cache
+    SESSION = requests_cache.CachedSession(
+        'alos_http_cache', expire_after=86400, cache_control=True)
+except ImportError:
+    SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=32,
+    max_retries=Retry(total=10, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504])))
+
 # %% latlon2tileid
 def latlon2tileid(lat, lon, zl):
     # https://www.trail-note.net/tech/coordinate/
     # https://note.sngklab.jp/?p=72
 
-    x = int((lon/180+1)*2**zl/2)
-    y = int(((-np.log(np.tan(np.deg2rad(45+lat/2)))+np.pi)*2**zl/(2*np.pi)))
+    x = int((lon/180+1)*(1<<zl)/2)
+    y = int(((-np.log(np.tan(np.deg2rad(45+lat/2)))+np.pi)*(1<<zl)/(2*np.pi)))
 
     return x, y
 
 
-# %% add_feature
-def add_feature(feature, geojson):
-    if not os.path.exists(geojson):
-        os.makedirs(os.path.dirname(geojson), exist_ok=True)
-        with open(geojson, 'x') as f:
-            json.dump({'type': 'FeatureCollection', 'features': []}, f)
-
-    with open(geojson, 'r') as f:
-        json_dict = json.load(f)
-        features_list = json_dict['features']
+# %% latlon2tileid_vec
+def latlon2tileid_vec(lat, lon, zl):
+    """
+    Vectorized latlon2tileid for arrays of lat and lon.
+    """
+    two_zl = 1<<zl
+    x = ((lon/180+1)*two_zl/2).astype(np.int64)
+    y = ((-np.log(np.tan(np.deg2rad(45+lat/2)))+np.pi)*two_zl/(2*np.pi)
+         ).astype(np.int64)
 
-    features_list.append(feature)
-
-    with open(geojson, 'w') as f:
-        json.dump({'type': 'FeatureCollection', 'features': features_list}, f)
+    return x, y
 
-# %%
-def download_txt(url, n_retry=10):
-    for i in range(n_retry):
-        try:
-            with requests.get(url) as res:
-                res.raise_for_status()
-                _list = res.text.splitlines()
-            return _list
-        except:
-            print(f'{i+1}st Download error')
-            pass # try again
 
-    raise Exception(f"Error while downloading from {url}")
+# %% write_geojson
+def write_geojson(features, geojson):
+    """
+    Write already serialized features (bytes) as GeoJSON FeatureCollection.
+    """
+    os.makedirs(os.path.dirname(geojson), exist_ok=True)
+    with open(geojson, 'wb', buffering=1<<20) as f:
+        f.write(b'{"type":"FeatureCollection","features":[')
+        for i, feature in enumerate(features):
+            if i > 0:
+                f.write(b',')
+            f.write(feature)
+        f.write(b']}')
+
+
+# %% append_ndjson
+def append_ndjson(features, ndjson):
+    """
+    Append features to NDJSON shard (1 feature per line) of a tile.
+    """
+    os.makedirs(os.path.dirname(ndjson), exist_ok=True)
+    with open(ndjson, 'ab') as f:
+        f.write(b''.join([json_dumps(feature)+b'\n' for feature in features]))
+
+
+# %% merge_ndjson
+def merge_ndjson(ndjson):
+    """
+    Write NDJSON shard into GeoJSON tile (w/o .ndjson) and remove shard.
+    """
+    with open(ndjson, 'rb') as f:
+        features = [l.rstrip(b'\n') for l in f if l.strip()] # not parsed
+    write_geojson(features, ndjson[:-len('.ndjson')])
+    os.remove(ndjson)
+
+
+# %% flush_features
+def flush_features(frames, lats_c, lons_c, zl):
+    """
+    Identify tile IDs of buffered frames and append features to the shards.
+    Return set of the shard paths.
+    """
+    xs, ys = latlon2tileid_vec(np.array(lats_c), np.array(lons_c), zl)
+    tile_features = defaultdict(list) # {ndjson: [features]}
+    for (out_feature, outdir), x, y in zip(frames, xs, ys):
+        ndjson = os.path.join(outdir, str(zl), str(x), str(y)+'.geojson.ndjson')
+        tile_features[ndjson].append(out_feature)
+
+    for ndjson, features in tile_features.items():
+        append_ndjson(features, ndjson)
+
+    return set(tile_features.keys())
+
+
+# %% download_txt
+def download_txt(url):
+    # Retries are handled by the HTTPAdapter mounted on SESSION
+    res = SESSION.get(url, timeout=30)
+    res.raise_for_status()
+    return res.text.splitlines()
+
+
+# %% Settings
+line_colorA = "#0000ff"
+line_colorD = "#ff0000"
+line_opacity = 0.7
+line_width = 1
+fill_opacity = 0.5
+
+url_list_base = 'https://gsrt.digiarc.aist.go.jp/insarbrowser/doc'
+url_alltxt = os.path.join(url_list_base, 'all_products_list.txt')
+url_gunw_base = 'https://s3.abci.ai/palsar-insar-pds/P1INSAR/GUNW'
+
+bname = 'ALOSframe'
+n_flush = 500 # Number of frames buffered before appending to shards
+
+
+# %% process_frame
+def process_frame(plisttxt):
+    """
+    Download info of a frame and make GeoJSON feature.
+    Independent per frame so that it can run in download threads.
+    """
+    start1 = time.time()
+
+    # %% Read info
+    frameid = plisttxt.replace(url_list_base, '').replace(
+        'products_list.txt', '').replace('/', '')
+
+    # frameid is fixed width PPP_FFFF_III (e.g., 045_2700_343), so zero-padded
+    # frame can be compared as string
+    frame = frameid[4:8]
+    inc = '343' if frameid[9:12] == '343' else 'others'
+    if '1810' <= frame <= '5400':
+        AD = 'D'
+        line_color = line_colorD
+    else:
+        AD = 'A'
+        line_color = line_colorA
+
+    products_list = download_txt(plisttxt)
+
+    # Unwrap rate
+    url_unwratetxt = os.path.join(url_list_base, frameid,
+                                  'unwrap_rates_list.txt')
+    unwrates = download_txt(url_unwratetxt)
+    unwrates_dict = {}
+    for l in unwrates:
+        unwrates_dict[l.split(',')[0]] = float(l.split(',')[1])
+
+    # bperp and number
+    url_baselines = os.path.join(url_gunw_base, frameid,
+                                 f'{frameid}_GUNW.baselines')
+    baselines = download_txt(url_baselines)
+    bperp_dict = {} # e.g. '20070312': 19.008
+    for l in baselines:
+        bperp_dict[l.split()[1]] = float(l.split()[-2])
+        bperp_dict[l.split()[2]] = float(l.split()[-1])
+
+    n_im = len(bperp_dict)
+    n_ifg = len(baselines)
+
+    if n_im >= 32:
+        color = line_color
+    else:
+        color = line_color.replace('0000', hex(255-n_im*8)[2:].zfill(2)*2)
+
+    # latlon
+    url_gunwtxt = None
+    for file in products_list:
+        if 'GUNW.txt' in file:
+            url_gunwtxt = file
+            break
+    gunwtxt = download_txt(url_gunwtxt)
+
+    meta = {}
+    for s in gunwtxt:
+        if '=' not in s: continue
+        key, _, val = s.partition('=')
+        meta[key.strip()] = val.strip()
+
+    lat_sn = float(meta['SceneStartNearRangeLatitudeDegree'])
+    lon_sn = float(meta.get('SceneStartNearRangeLongitudeDegree',
+                            meta.get('SceneStartNearRangeLongitudeDegre')))
+    lat_sf = float(meta['SceneStartFarRangeLatitudeDegree'])
+    lon_sf = float(meta['SceneStartFarRangeLongitudeDegree'])
+    lat_en = float(meta['SceneEndNearRangeLatitudeDegree'])
+    lon_en = float(meta['SceneEndNearRangeLongitudeDegree'])
+    lat_ef = float(meta['SceneEndFarRangeLatitudeDegree'])
+    lon_ef = float(meta['SceneEndFarRangeLongitudeDegree'])
+    lat_c = float(meta['SceneCenterLatitudeDegree'])
+    lon_c = float(meta['SceneCenterLongitudeDegree'])
+
+
+    # %% Make feature
+    url_networkpng = os.path.join(url_list_base, frameid, 'network.png')
+    coords = [[[lon_sn, lat_sn], [lon_sf, lat_sf], [lon_ef, lat_ef],
+               [lon_en, lat_en], [lon_sn, lat_sn]]]
+    geometry = {"type": "Polygon", "coordinates": coords}
+    descr = f'# epochs: {n_im}<br># ifgs: {n_ifg}<br>' \
+            f'<a href="{plisttxt}" target="_blank">Product list</a><br>' \
+            f'<a href="{url_networkpng}" target="_blank">' \
+            f'<img src="{url_networkpng}" width="500"></a>'
+
+    ### Add description? n_poch, n_ifg, url, networkpng
+    properties = {"name": frameid, "description": descr,
+                  "_color": line_color, "_opacity": line_opacity,
+                   "_weight": line_width, "_fillColor": color,
+                   "_fillOpacity": fill_opacity}
+    out_feature = {'type': 'Feature', 'properties': properties,
+                   'geometry': geometry}
+
+    outdir = bname+f'{AD}{inc}'
+
+    elapsed_time1 = datetime.timedelta(seconds=(time.time()-start1))
+    info = f'{frameid} {AD}, # im: {n_im}, Elapsed time: {elapsed_time1}'
+
+    return out_feature, outdir, lat_c, lon_c, info
 
 
 # %% Main
 def main(argv=None):
 
-    # %% Settings
-    line_colorA = "#0000ff"
-    line_colorD = "#ff0000"
-    line_opacity = 0.7
-    line_width = 1
-    fill_opacity = 0.5
-
-    url_list_base = 'https://gsrt.digiarc.aist.go.jp/insarbrowser/doc'
-    url_alltxt = os.path.join(url_list_base, 'all_products_list.txt')
-    url_gunw_base = 'https://s3.abci.ai/palsar-insar-pds/P1INSAR/GUNW'
-
-
     # %% Read arg
     start = time.time()
     prog = os.path.basename(sys.argv[0])
@@ -86,18 +263,24 @@ def main(argv=None):
     addarg = parser.add_argument
     addarg('-z', '--zoomlevel', type=int, default=5,
             help='Output zoom level')
+    addarg('-n', '--n_para', type=int, default=8,
+            help='Number of frames downloaded in parallel')
+    addarg('--refresh', action='store_true',
+            help='Clear HTTP cache and download all files again')
     args = parser.parse_args()
 
+    if args.refresh and hasattr(SESSION, 'cache'):
+        SESSION.cache.clear()
+
     zl = args.zoomlevel
+    n_para = args.n_para
 
 
     # %% Output geojson tile dirs and network dirs
-    bname = 'ALOSframe'
     for inc in ['343', 'others']:
         for AD in ['A', 'D']:
             bdir = bname+f'{AD}{inc}'
-            if os.path.exists(bdir):
-                subprocess.run(['rm', '-rf', bdir])
+            shutil.rmtree(bdir, ignore_errors=True)
             zldir = os.path.join(bdir, str(zl))
             os.makedirs(zldir)
 
@@ -107,111 +290,37 @@ def main(argv=None):
     all_list = download_txt(url_alltxt)
     n_all = len(all_list)
 
-    print('For each frame ID')
-    for i, plisttxt in enumerate(all_list):
-        start1 = time.time()
-
-        # %% Read info
-        frameid = plisttxt.replace(url_list_base, '').replace(
-            'products_list.txt', '').replace('/', '')
-        print(f'{i+1}/{n_all} {frameid} {AD},', end='')
-
-        path, frame, inc = frameid.split('_')
-        if inc != '343': inc = 'others'
-        if 1810 <= int(frame) <= 5400:
-            AD = 'D'
-            line_color = line_colorD
-        else:
-            AD = 'A'
-            line_color = line_colorA
-
-        products_list = download_txt(plisttxt)
-
-        # Unwrap rate
-        url_unwratetxt = os.path.join(url_list_base, frameid,
-                                      'unwrap_rates_list.txt')
-        unwrates = download_txt(url_unwratetxt)
-        unwrates_dict = {}
-        for l in unwrates:
-            unwrates_dict[l.split(',')[0]] = float(l.split(',')[1])
-
-        # bperp and number
-        url_baselines = os.path.join(url_gunw_base, frameid,
-                                     f'{frameid}_GUNW.baselines')
-        baselines = download_txt(url_baselines)
-        bperp_dict = {} # e.g. '20070312': 19.008
-        for l in baselines:
-            bperp_dict[l.split()[1]] = float(l.split()[-2])
-            bperp_dict[l.split()[2]] = float(l.split()[-1])
-
-        n_im = len(bperp_dict)
-        n_ifg = len(baselines)
-
-        if n_im >= 32:
-            color = line_color
-        else:
-            color = line_color.replace('0000', hex(255-n_im*8)[2:].zfill(2)*2)
-
-        # latlon
-        url_gunwtxt = None
-        for file in products_list:
-            if 'GUNW.txt' in file:
-                url_gunwtxt = file
-                break
-        gunwtxt = download_txt(url_gunwtxt)
-
-        lat_sn = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneStartNearRangeLatitudeDegree' in s][0]
-        lon_sn = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneStartNearRangeLongitudeDegre' in s][0]
-        lat_sf = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneStartFarRangeLatitudeDegree' in s][0]
-        lon_sf = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneStartFarRangeLongitudeDegree' in s][0]
-        lat_en = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneEndNearRangeLatitudeDegree' in s][0]
-        lon_en = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneEndNearRangeLongitudeDegree' in s][0]
-        lat_ef = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneEndFarRangeLatitudeDegree' in s][0]
-        lon_ef = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneEndFarRangeLongitudeDegree' in s][0]
-        lat_c = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneCenterLatitudeDegree' in s][0]
-        lon_c = [float(s.split('=')[-1]) for s in gunwtxt
-                 if 'SceneCenterLongitudeDegree' in s][0]
-
-
-        # %% Append geojson
-        url_networkpng = os.path.join(url_list_base, frameid, 'network.png')
-        coords = [[[lon_sn, lat_sn], [lon_sf, lat_sf], [lon_ef, lat_ef],
-                   [lon_en, lat_en], [lon_sn, lat_sn]]]
-        geometry = {"type": "Polygon", "coordinates": coords}
-        descr = f'# epochs: {n_im}<br># ifgs: {n_ifg}<br>' \
-                f'<a href="{plisttxt}" target="_blank">Product list</a><br>' \
-                f'<a href="{url_networkpng}" target="_blank">' \
-                f'<img src="{url_networkpng}" width="500"></a>'
-
-        ### Add description? n_poch, n_ifg, url, networkpng
-        properties = {"name": frameid, "description": descr,
-                      "_color": line_color, "_opacity": line_opacity,
-                       "_weight": line_width, "_fillColor": color,
-                       "_fillOpacity": fill_opacity}
-        out_feature = {'type': 'Feature', 'properties': properties,
-                       'geometry': geometry}
-
-        # Identify tile ID
-        x, y = latlon2tileid(lat_c, lon_c, zl)
-
-        # Add feature
-        out_jsonfile = os.path.join(bname+f'{AD}{inc}', str(zl), str(x),
-                                    str(y)+'.geojson')
-        add_feature(out_feature, out_jsonfile)
-
-
-        # %% Remove geojson
-        elapsed_time1 = datetime.timedelta(seconds=(time.time()-start1))
-        print(f"# im: {n_im}, Elapsed time: {elapsed_time1}")
+    print(f'For each frame ID ({n_para} parallel)')
+    frames = [] # [(out_feature, outdir)]
+    lats_c = []
+    lons_c = []
+    flushes = []
+    # Single writer thread keeps shard appends in order while the
+    # download threads continue
+    with ThreadPoolExecutor(max_workers=n_para) as ex, \
+         ThreadPoolExecutor(max_workers=1) as writer:
+        results = ex.map(process_frame, all_list)
+        for i, (out_feature, outdir, lat_c, lon_c, info) in enumerate(results):
+            print(f'{i+1}/{n_all} {info}')
+            frames.append((out_feature, outdir))
+            lats_c.append(lat_c)
+            lons_c.append(lon_c)
+
+            # Append features to NDJSON shards of tiles
+            if len(frames) >= n_flush or i+1 == n_all:
+                flushes.append(writer.submit(flush_features, frames, lats_c,
+                                             lons_c, zl))
+                frames, lats_c, lons_c = [], [], []
+
+    shards = set()
+    for flush in flushes:
+        shards |= flush.result()
+
+
+    # %% Write geojson tiles
+    print(f'Write {len(shards)} GeoJSON tiles')
+    with ThreadPoolExecutor(max_workers=n_para) as ex:
+        list(ex.map(merge_ndjson, shards))
 
 
     # %% Finish
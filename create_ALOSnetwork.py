@@ -11,59 +11,120 @@ import sys
 import os
 import time
 import datetime
+from multiprocessing import Pool
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from matplotlib import pyplot as plt
 from matplotlib import dates as mdates
+from matplotlib.collections import LineCollection
 import matplotlib as mpl
 from matplotlib.patheffects import withStroke
 from adjustText import adjust_text
+from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 os.environ['LANG'] = 'en_US.UTF-8'
 mpl.use('Agg')
 
+# Pooled HTTP session (keep-alive) shared by all downloads
+# Cached on disk by requests_cache (if installed); revalidated with
+# ETag/Last-Modified after 1 day
+try:
+    import requests_cache
+    SESSION = requests_cache.CachedSession(
+        'alos_http_cache', expire_after=86400, cache_control=True)
+except ImportError:
+    SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=32,
+    max_retries=Retry(total=10, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504])))
+
+
+# %% get_figure
+_figure = None # (fig, ax, cmap) reused across plot_network calls
+
+def get_figure():
+    """
+    Return figure, axes and colormap for plot_network, created once per
+    process with the colorbar, which is the same for all frames.
+    """
+    global _figure
+    if _figure is None:
+        fig = plt.figure(figsize=(12, 5))
+        ax = fig.add_axes([0.08, 0.10, 0.87,0.88])
+        cmap = plt.get_cmap('cividis_r', 100)
+
+        # Colorbar
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="2%", pad=0.05)
+        norm = mpl.colors.Normalize(vmin=0, vmax=100)
+        sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+        cbar = fig.colorbar(sm, cax=cax, alpha=0.8)
+        cbar.set_label('Unwrap rate (%)')
+
+        _figure = (fig, ax, cmap)
+
+    return _figure
+
 
 # %% plot_network
-def plot_network(bperp_dict, unwrates_dict, frameid, pngfile):
+def plot_network(imdates, bperp, unwmat, frameid, pngfile):
     """
     Plot network of interferometric pairs with colors of unw_rate.
+    unwmat[i, j] is unw_rate of imdates[i]_imdates[j] (nan if no ifg).
     """
 
-    imdates = list(bperp_dict.keys())
-    bperp = list(bperp_dict.values())
     n_im = len(imdates)
-    imdates_dt = np.array(([datetime.datetime.strptime(imd, '%Y%m%d')
-                            for imd in imdates]))
+    imdates_dt = np.array([f'{s[:4]}-{s[4:6]}-{s[6:8]}' for s in imdates],
+                          dtype='datetime64[D]'
+                          ).astype('datetime64[us]').astype(datetime.datetime)
 
     # Plot fig
-    fig = plt.figure(figsize=(12, 5))
-    ax = fig.add_axes([0.08, 0.10, 0.87,0.88])
+    fig, ax, cmap = get_figure()
+    ax.clear()
 
-    cmap = plt.get_cmap('cividis_r', 100)
     texts = []
     effects = [withStroke(linewidth=2, foreground="w")]
 
+    # Epochs
+    ax.scatter(imdates_dt, bperp, c='k', alpha=0.6, zorder=101)
+    late = imdates_dt > datetime.datetime(2008, 8, 3)
+    vas = np.where(late, 'top', 'bottom')
+    has = np.where(late, 'left', 'right')
     for i, imd in enumerate(imdates):
-        # Epochs
-        ax.scatter(imdates_dt[i], bperp[i], c='k', alpha=0.6, zorder=101)
-        if imdates_dt[i].date() > datetime.date(2008, 8, 3):
-            va, ha = 'top', 'left'
-        else:
-            va, ha = 'bottom', 'right'
         text = ax.annotate(imd[4:6]+'/'+imd[6:], (imdates_dt[i], bperp[i]),
-                           ha=ha, va=va, zorder=102, fontweight='normal',
-                           path_effects=effects, alpha=0.8)
+                           ha=has[i], va=vas[i], zorder=102,
+                           fontweight='normal', path_effects=effects,
+                           alpha=0.8)
         texts.append(text)
 
-        # Interferograms
-        for j in range(i+1, n_im):
-            if f'{imd}_{imdates[j]}' in unwrates_dict:
-                unwrate1 = int(unwrates_dict[f'{imd}_{imdates[j]}'])
-                ax.plot([imdates_dt[i], imdates_dt[j]], [bperp[i], bperp[j]],
-                         color=cmap(unwrate1), alpha=0.8, zorder=unwrate1,
-                         linewidth=2)
-
-    adjust_text(texts)
+    # Interferograms
+    ix, jx = np.triu_indices(n_im, 1)
+    unwrates_arr = unwmat[ix, jx]
+    valid = ~np.isnan(unwrates_arr)
+    ix, jx = ix[valid], jx[valid]
+    unwrates_arr = unwrates_arr[valid].astype(np.int64)
+
+    # Draw higher unwrap rate on top (as zorder=unwrate)
+    order = np.argsort(unwrates_arr, kind='stable')
+    ix, jx, unwrates_arr = ix[order], jx[order], unwrates_arr[order]
+
+    datenum = mdates.date2num(imdates_dt)
+    segs = np.empty((len(ix), 2, 2))
+    segs[:, 0, 0] = datenum[ix]
+    segs[:, 0, 1] = bperp[ix]
+    segs[:, 1, 0] = datenum[jx]
+    segs[:, 1, 1] = bperp[jx]
+    colors_tab = cmap(np.arange(cmap.N))
+    colors = colors_tab[np.clip(unwrates_arr, 0, cmap.N-1)] # as cmap(int)
+    lc = LineCollection(segs, colors=colors, linewidths=2, alpha=0.8)
+    ax.add_collection(lc)
+    ax.autoscale_view()
+
+    adjust_text(texts, ax=ax)
 
     # Locater
     loc = ax.xaxis.set_major_locator(mdates.AutoDateLocator())
@@ -78,31 +139,57 @@ def plot_network(bperp_dict, unwrates_dict, frameid, pngfile):
                  datetime.datetime.strptime('20110801', '%Y%m%d')))
 
     # Labels and legend
-    plt.xlabel('Time [year]')
-    plt.ylabel('Bperp [m]')
-    plt.text(0.01, 0.95, frameid, fontweight='bold', transform=ax.transAxes)
+    ax.set_xlabel('Time [year]')
+    ax.set_ylabel('Bperp [m]')
+    ax.text(0.01, 0.95, frameid, fontweight='bold', transform=ax.transAxes)
 
-    # Colorbar
-    from mpl_toolkits.axes_grid1 import make_axes_locatable
-    divider = make_axes_locatable(ax)
-    cax = divider.append_axes("right", size="2%", pad=0.05)
-    norm = mpl.colors.Normalize(vmin=0, vmax=100)
-    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    cbar = plt.colorbar(sm, cax=cax, alpha=0.8)
-    cbar.set_label('Unwrap rate (%)')
+    # Save (figure is kept for the next frame)
+    fig.savefig(pngfile)
 
-    # Save
-    plt.savefig(pngfile)
-    plt.close()
 
+# %% Settings
+url_list_base = 'https://gsrt.digiarc.aist.go.jp/insarbrowser/doc'
+url_gunw_base = 'https://s3.abci.ai/palsar-insar-pds/P1INSAR/GUNW'
+maxtasksperchild = 50 # Restart workers to bound matplotlib memory growth
 
-# %% Main
-def main(argv=None):
 
-    # %% Settings
-    url_list_base = 'https://gsrt.digiarc.aist.go.jp/insarbrowser/doc'
-    url_gunw_base = 'https://s3.abci.ai/palsar-insar-pds/P1INSAR/GUNW'
+# %% get_network_info
+def get_network_info(frameid):
+    """
+    Download bperp and unwrap rates of a frame.
+    Return imdates (list), bperp (n_im) and unw_rate matrix (n_im, n_im).
+    """
+    # bperp and number
+    url_baselines = os.path.join(url_gunw_base, frameid,
+                                 f'{frameid}_GUNW.baselines')
+    baselines = SESSION.get(url_baselines, timeout=30).text.splitlines()
+    bperp_dict = {} # e.g. '20070312': 19.008
+    for l in baselines:
+        cols = l.split()
+        bperp_dict[cols[1]] = float(cols[-2])
+        bperp_dict[cols[2]] = float(cols[-1])
 
+    imdates = list(bperp_dict.keys())
+    bperp = np.array(list(bperp_dict.values()))
+    n_im = len(imdates)
+    idx = {imd: i for i, imd in enumerate(imdates)}
+
+    # Unwrap rate
+    url_unwratetxt = os.path.join(url_list_base, frameid,
+                                  'unwrap_rates_list.txt')
+    unwrates = SESSION.get(url_unwratetxt, timeout=30).text.splitlines()
+    unwmat = np.full((n_im, n_im), np.nan)
+    for l in unwrates:
+        pair, unwrate = l.split(',')[:2]
+        imd1, imd2 = pair.split('_')
+        if imd1 in idx and imd2 in idx:
+            unwmat[idx[imd1], idx[imd2]] = float(unwrate)
+
+    return imdates, bperp, unwmat
+
+
+# %% Main
+def main(argv=None):
 
     # %% Read arg
     start = time.time()
@@ -113,9 +200,24 @@ def main(argv=None):
 
     parser = argparse.ArgumentParser(description=description)
     addarg = parser.add_argument
-    addarg('-f', '--frameid', type=str, help='Frame id (e.g., 045_2700_343)')
+    addarg('-f', '--frameid', type=str, nargs='+', default=[],
+            help='Frame id(s) (e.g., 045_2700_343)')
+    addarg('-l', '--frameid_list', type=str,
+            help='Text file of frame ids (e.g., frameid_list.txt)')
+    addarg('-n', '--n_para', type=int, default=os.cpu_count(),
+            help='Number of parallel processes for plotting')
+    addarg('--refresh', action='store_true',
+            help='Clear HTTP cache and download all files again')
     args = parser.parse_args()
-    frameid = args.frameid
+
+    if args.refresh and hasattr(SESSION, 'cache'):
+        SESSION.cache.clear()
+
+    frameids = list(args.frameid)
+    if args.frameid_list:
+        with open(args.frameid_list) as f:
+            frameids.extend([l.strip() for l in f if l.strip()])
+    n_para = args.n_para
 
 
     # %% Output network dir
@@ -123,27 +225,16 @@ def main(argv=None):
 
 
     # %% Read info
-    # Unwrap rate
-    url_unwratetxt = os.path.join(url_list_base, frameid,
-                                  'unwrap_rates_list.txt')
-    unwrates = requests.get(url_unwratetxt).text.splitlines()
-    unwrates_dict = {}
-    for l in unwrates:
-        unwrates_dict[l.split(',')[0]] = float(l.split(',')[1])
-
-    # bperp and number
-    url_baselines = os.path.join(url_gunw_base, frameid,
-                                 f'{frameid}_GUNW.baselines')
-    baselines = requests.get(url_baselines).text.splitlines()
-    bperp_dict = {} # e.g. '20070312': 19.008
-    for l in baselines:
-        bperp_dict[l.split()[1]] = float(l.split()[-2])
-        bperp_dict[l.split()[2]] = float(l.split()[-1])
+    plot_args = []
+    for frameid in frameids:
+        imdates, bperp, unwmat = get_network_info(frameid)
+        pngfile = os.path.join('network', f'network_{frameid}.png')
+        plot_args.append((imdates, bperp, unwmat, frameid, pngfile))
 
 
     # %% Create network plot
-    pngfile = os.path.join('network', f'network_{frameid}.png')
-    plot_network(bperp_dict, unwrates_dict, frameid, pngfile)
+    with Pool(n_para, maxtasksperchild=maxtasksperchild) as p:
+        p.starmap(plot_network, plot_args)
 
 
     # %% Finish
@@ -151,7 +242,10 @@ def main(argv=None):
     print(f"\nElapsed time: {elapsed_time}")
     print(f'\n{prog} Successfully finished!!\n')
 
-    print(f"Output: {pngfile}\n")
+    if len(plot_args) == 1:
+        print(f"Output: {plot_args[0][-1]}\n")
+    else:
+        print(f"Output: network/network_*.png ({len(plot_args)} files)\n")
 
 
 # %% main
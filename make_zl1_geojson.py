@@ -12,12 +12,25 @@ import sys
 import os
 import time
 import datetime
-import glob
+from concurrent.futures import ThreadPoolExecutor
 import json
-from shapely.geometry import Polygon, MultiPolygon
+import shapely
 from shapely.ops import unary_union
+from shapely.strtree import STRtree
 import numpy as np
 
+try:
+    import orjson
+    def json_loads(b):
+        return orjson.loads(b)
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError: # fall back to stdlib json
+    def json_loads(b):
+        return json.loads(b)
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 
 # %% latlon2tileid
 def latlon2tileid(lat, lon, zl):
@@ -34,17 +47,66 @@ def latlon2tileid(lat, lon, zl):
 def add_feature(feature, geojson):
     if not os.path.exists(geojson):
         os.makedirs(os.path.dirname(geojson), exist_ok=True)
-        with open(geojson, 'x') as f:
-            json.dump({'type': 'FeatureCollection', 'features': []}, f)
+        with open(geojson, 'xb') as f:
+            f.write(json_dumps({'type': 'FeatureCollection', 'features': []}))
 
-    with open(geojson, 'r') as f:
-        json_dict = json.load(f)
+    with open(geojson, 'rb') as f:
+        json_dict = json_loads(f.read())
         features_list = json_dict['features']
 
     features_list.append(feature)
 
-    with open(geojson, 'w') as f:
-        json.dump({'type': 'FeatureCollection', 'features': features_list}, f)
+    with open(geojson, 'wb') as f:
+        f.write(json_dumps({'type': 'FeatureCollection',
+                            'features': features_list}))
+
+
+# %% iter_tile_paths
+def iter_tile_paths(zldir):
+    for d in os.scandir(zldir):
+        if d.is_dir():
+            for f in os.scandir(d.path):
+                if f.name.endswith('.geojson'):
+                    yield f.path
+
+
+# %% load_features
+def load_features(geojson):
+    with open(geojson, 'rb') as f:
+        json_dict = json_loads(f.read())
+    return json_dict['features']
+
+
+# %% dissolve
+def dissolve(polygons):
+    """
+    Union polygons per cluster of overlapping bboxes (found with STRtree),
+    then union the clusters.
+    """
+    if len(polygons) == 0:
+        return unary_union(polygons)
+
+    # Connected components of bbox intersections (union-find)
+    tree = STRtree(polygons)
+    src, dst = tree.query(polygons)
+    parent = np.arange(len(polygons))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(src, dst):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[ri] = rj
+
+    clusters = {}
+    for i in range(len(polygons)):
+        clusters.setdefault(find(i), []).append(polygons[i])
+
+    return unary_union([unary_union(c) for c in clusters.values()])
 
 
 # %% Main
@@ -87,29 +149,32 @@ def main(argv=None):
 
 
     # %% For each input geojson files
-    polygons = [] # For dissolved geojson
-    for _json in glob.glob(os.path.join(zldir, '*', '*.geojson')):
-        with open(_json, 'r') as f:
-            json_dict = json.load(f)
-        features_list = json_dict['features']
-
-        color = features_list[0]['properties']['_color']
-
-        for feature in features_list:
-            geometry = feature['geometry']
-            lat = geometry['coordinates'][0][0][1]
-            if lat > 84 or lat < -84: # cannot display on web map
-                continue
-
-            polygons.append(Polygon(feature['geometry']['coordinates'][0]))
+    rings = [] # Exterior coords for dissolved geojson
+    with ThreadPoolExecutor(16) as ex:
+        for features_list in ex.map(load_features, iter_tile_paths(zldir)):
+            color = features_list[0]['properties']['_color']
+
+            rings.extend([feature['geometry']['coordinates'][0]
+                          for feature in features_list])
+
+    # Make polygons at once
+    n_nodes = np.array([len(ring) for ring in rings], dtype=np.int64)
+    coords = np.array([xy for ring in rings for xy in ring],
+                      dtype=np.float64).reshape(-1, 2)
+    ring_idx = np.repeat(np.arange(len(rings)), n_nodes)
+    lat = coords[np.cumsum(n_nodes)-n_nodes, 1] # 1st node of each ring
+    mask = (lat <= 84) & (lat >= -84) # cannot display on web map
+    keep = mask[ring_idx]
+    _, ring_idx = np.unique(ring_idx[keep], return_inverse=True)
+    polygons = shapely.polygons(shapely.linearrings(coords[keep],
+                                                    indices=ring_idx))
 
 
     # %% Make dissolved geojson
-    dissolved_poly = unary_union(MultiPolygon(polygons))
-    if dissolved_poly.type == 'Polygon': # 1 segment
-        dissolved_poly = [dissolved_poly]
-    for _poly in dissolved_poly:
-        poly2 = _poly.simplify(tolerance)
+    dissolved_poly = dissolve(polygons)
+    simplified_polys = shapely.simplify(shapely.get_parts(dissolved_poly),
+                                        tolerance)
+    for poly2 in simplified_polys:
         poly2_list = [list(i) for i in poly2.exterior.coords[:]]
         print(f'Number of nodes: {len(poly2_list)}')
         geometry2 = {'type': 'Polygon', 'coordinates': [poly2_list]}